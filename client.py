@@ -5,39 +5,115 @@ A Tardis machine-server normalized websocket client
 to download data from a lookback period to now.
 """
 
+import atexit
 import logging
+import logging.handlers
+import sys
 import asyncio
 import aiohttp
-import json
+import uvloop
+import orjson
+import numpy as np
 import urllib.parse
+from bisect import bisect_left, bisect_right
+from collections import deque
+from operator import itemgetter
+from queue import SimpleQueue
 from datetime import datetime, timedelta
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import inspect
+from sqlalchemy.dialects.sqlite import insert
 
 import models
 
 GET_HIST_DATA_TIMEOUT = 30 * 60  # 30 minutes
+RECORD_BATCH_SIZE = 100  # rows per INSERT when recording live data
+RECORD_QUEUE_SIZE = 10000  # live data entries waiting to be written
+# Websocket frames carrying data, passed as-is (str or bytes) to orjson.
+# ERROR frames are raised, other control frames are skipped.
+DATA_MSG_TYPES = (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY)
 
 logger = logging.getLogger("tardis_client")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)  # DEBUG logs every received live data entry
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 ch.setFormatter(formatter)
-logger.addHandler(ch)
+# Write log records from a background thread, not the event loop
+log_queue = SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, ch)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 
-def parse_msg(msg_s: str):
+def _parse_ts(s: str) -> datetime:
     """
-    Convert message string to dictionary and flatten it.
+    Parse a fixed-shape UTC timestamp like `2022-04-28T22:17:45.105Z`
+    into a naive datetime by slicing fixed offsets.
     """
-    msg: dict = eval(msg_s)
-    msg["dtype"] = msg["type"]
-    msg.pop("type")
-    msg["timestamp"] = datetime.fromisoformat(msg["timestamp"].rstrip("Z"))
-    msg["localTimestamp"] = datetime.fromisoformat(msg["localTimestamp"].rstrip("Z"))
+    frac = s[20:-1]
+    return datetime(
+        int(s[0:4]),
+        int(s[5:7]),
+        int(s[8:10]),
+        int(s[11:13]),
+        int(s[14:16]),
+        int(s[17:19]),
+        int(frac[:6].ljust(6, "0")) if frac else 0,
+    )
+
+
+def parse_msg_raw(msg_s: str | bytes) -> dict:
+    """
+    Convert JSON message string to dictionary, keeping bids/asks nested.
+    """
+    msg: dict = orjson.loads(msg_s)
+    msg["dtype"] = msg.pop("type")
+    msg["timestamp"] = _parse_ts(msg["timestamp"])
+    msg["localTimestamp"] = _parse_ts(msg["localTimestamp"])
+    return msg
+
+
+def _make_flattener(sources: tuple, fields: tuple):
+    """
+    Generate a function flattening messages of a fixed schema with straight
+    line assignments, no loops or key formatting per message.
+    """
+    lines = ["def _flatten(msg):"]
+    for i, (src, _) in enumerate(sources):
+        lines.append(f"    src_{i} = msg.pop({src!r})")
+    src_index = {src: i for i, (src, _) in enumerate(sources)}
+    for src, level, sub, dst in fields:
+        lines.append(f"    msg[{dst!r}] = src_{src_index[src]}[{level}][{sub!r}]")
+    lines.append("    return msg")
+    namespace = {}
+    exec(compile("\n".join(lines), "<flatten_msg>", "exec"), namespace)
+    return namespace["_flatten"]
+
+
+def _build_flatten_schema(msg: dict) -> tuple:
+    """
+    Build the flattening schema of a raw message: the nested list keys with
+    their number of levels, and the generated function flattening them.
+    """
+    sources = []
+    fields = []
+    for key, val in msg.items():
+        if not isinstance(val, list):
+            continue
+        sources.append((key, len(val)))
+        for level, val_dict in enumerate(val):
+            for k in val_dict:
+                fields.append((key, level, k, sys.intern(f"{key}_{level}_{k}")))
+    sources = tuple(sources)
+    return sources, _make_flattener(sources, tuple(fields))
+
+
+# Flattening schemas cached by (data type name, depth)
+_FLATTEN_SCHEMA: dict = {}
+
+
+def _flatten_msg_generic(msg: dict) -> dict:
     bid_ask = [key for key, val in msg.items() if isinstance(val, list)]
     for key in bid_ask:
         bid_ask_list = msg.pop(key)
@@ -48,15 +124,92 @@ def parse_msg(msg_s: str):
     return msg
 
 
-def parse_orm_select_results(results):
-    results_list = [
-        {
-            col.key: getattr(r, col.key)
-            for col in inspect(r).mapper.column_attrs
-            if getattr(r, col.key) is not None
-        }
-        for r, in results
-    ]
+def flatten_msg(msg: dict) -> dict:
+    """
+    Flatten bids/asks nested lists of a raw message for each depth level.
+
+    The schema and its generated flattening function are built once per data
+    type and depth, from the first full-depth book, and reused. Messages
+    without a depth or not matching the schema, e.g. with fewer book levels,
+    take the generic path.
+    """
+    depth = msg.get("depth")
+    if depth is None:
+        return _flatten_msg_generic(msg)
+    schema_key = (msg.get("name"), depth)
+    schema = _FLATTEN_SCHEMA.get(schema_key)
+    if schema is None:
+        # Only generate and cache the schema of a full-depth book
+        if not all(
+            len(val) == depth for val in msg.values() if isinstance(val, list)
+        ):
+            return _flatten_msg_generic(msg)
+        schema = _FLATTEN_SCHEMA[schema_key] = _build_flatten_schema(msg)
+    sources, flatten = schema
+    for src, n_levels in sources:
+        val = msg.get(src)
+        if not isinstance(val, list) or len(val) != n_levels:
+            return _flatten_msg_generic(msg)
+    return flatten(msg)
+
+
+def parse_msg(msg_s: str | bytes) -> dict:
+    """
+    Convert JSON message string to dictionary and flatten it.
+    """
+    return flatten_msg(parse_msg_raw(msg_s))
+
+
+def flatten_batch(msgs: list) -> dict:
+    """
+    Flatten a batch of raw messages to columnar arrays at once.
+
+    Columns are collected across the whole batch, so messages of different
+    data types may be mixed. Scalar fields become one array per field, with
+    None where a message lacks the field. Bids/asks levels become
+    preallocated float64 arrays like `bids_0_price`, with NaN for levels
+    missing from a message.
+    """
+    n = len(msgs)
+    if n == 0:
+        return {}
+    # Ordered key sets across the batch
+    scalar_keys = {}
+    list_keys = {}
+    for m in msgs:
+        for key, val in m.items():
+            if isinstance(val, list):
+                list_keys[key] = None
+            else:
+                scalar_keys[key] = None
+    columns = {key: np.array([m.get(key) for m in msgs]) for key in scalar_keys}
+    for key in list_keys:
+        arrays = {}
+        for i, m in enumerate(msgs):
+            for level, val_dict in enumerate(m.get(key, ())):
+                for k, v in val_dict.items():
+                    arr = arrays.get((level, k))
+                    if arr is None:
+                        arr = arrays[(level, k)] = np.full(n, np.nan, dtype=np.float64)
+                    arr[i] = v
+        for level, k in sorted(arrays, key=itemgetter(0)):
+            columns[f"{key}_{level}_{k}"] = arrays[(level, k)]
+    return columns
+
+
+# Columns and base query of recorded book snapshots, built once.
+# The surrogate `id` key is left out to match the message fields.
+_BOOKSNAPSHOT_COLS = models.BookSnapshot.__table__.c
+_SELECT_BOOKSNAPSHOTS = select(
+    *(col for col in _BOOKSNAPSHOT_COLS if col.key != "id")
+).order_by(_BOOKSNAPSHOT_COLS.timestamp)
+
+
+def parse_select_results(rows):
+    """
+    Convert Core select result mappings to dictionaries without None values.
+    """
+    results_list = [{k: v for k, v in row.items() if v is not None} for row in rows]
     return results_list
 
 
@@ -67,7 +220,12 @@ async def get_hist_data(
     start="2022-04-26",
     end="2022-04-27",
     include_disconnect=False,
+    columnar=False,
 ):
+    """
+    Download historical data. Messages are collected raw and flattened once
+    at the end, as a list of dicts, or as columnar arrays if `columnar`.
+    """
     replay_options = {
         "exchange": exchange,
         "symbols": symbols,
@@ -76,16 +234,25 @@ async def get_hist_data(
         "to": end,
         "withDisconnectMessages": include_disconnect,
     }
-    options = urllib.parse.quote_plus(json.dumps(replay_options))
+    options = urllib.parse.quote_from_bytes(orjson.dumps(replay_options), safe="")
     URL = f"ws://localhost:8001/ws-replay-normalized?options={options}"
 
-    data = []
+    data = deque()  # appends without reallocating, sized into a list once
     async with aiohttp.ClientSession() as session:
         async with session.ws_connect(URL) as websocket:
             async for msg in websocket:
-                d = parse_msg(msg.data)  # convert string to dict
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    raise websocket.exception()
+                if msg.type not in DATA_MSG_TYPES:
+                    continue
+                d = parse_msg_raw(msg.data)  # convert str/bytes to dict
                 if d["dtype"] != "disconnect":
                     data.append(d)
+    if columnar:
+        return flatten_batch(data)
+    data = list(data)
+    for d in data:
+        flatten_msg(d)  # flattens in place
     return data
 
 
@@ -101,43 +268,130 @@ async def stream_live_data(
         "withDisconnectMessages": include_disconnect,
         "dataTypes": data_types,
     }
-    options = urllib.parse.quote_plus(json.dumps(stream_options))
+    options = urllib.parse.quote_from_bytes(orjson.dumps(stream_options), safe="")
     URL = f"ws://localhost:8001/ws-stream-normalized?options={options}"
 
     async with aiohttp.ClientSession() as session:
         async with session.ws_connect(URL) as websocket:
             async for msg in websocket:
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    raise websocket.exception()
+                if msg.type not in DATA_MSG_TYPES:
+                    continue
                 d = parse_msg(msg.data)
                 if d["dtype"] != "disconnect":
                     yield d
 
 
+# Core INSERT statements of recorded models, built once and executed with
+# lists of rows in column order, bypassing the ORM unit of work.
+# Rows already recorded, e.g. resent by the stream, are skipped.
+_INSERT_STMTS = {
+    models.BookSnapshot: insert(models.BookSnapshot.__table__).on_conflict_do_nothing(
+        index_elements=["dtype", "symbol", "exchange", "name", "timestamp"]
+    )
+}
+
+
+async def flush_buffers(session, buffers: dict):
+    """
+    Insert buffered rows of each model in one multi-row INSERT and commit once.
+    """
+    # Take the rows out of the buffers before awaiting, so a cancel during
+    # the commit can't leave already committed rows to be inserted again.
+    batches = {model: rows for model, rows in buffers.items() if rows}
+    if not batches:
+        return
+    for model in batches:
+        buffers[model] = []
+    for model, rows in batches.items():
+        await session.execute(_INSERT_STMTS[model], rows)
+    await session.commit()
+
+
+async def enqueue_live_data(stream, queue: asyncio.Queue, model_lookup: dict):
+    """
+    Receive live data from the stream and put the entries to record on the
+    queue as (model, message object) pairs, without waiting for the database.
+    """
+    async for entry in stream:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received Live Data: %s", entry)
+        # Discard 1st live point which is not aligned with interval.
+        t = entry["timestamp"]
+        if (t.second * 1000 + t.microsecond / 1000) % entry["interval"] != 0:
+            continue
+        lookup = model_lookup.get(entry["dtype"], None)
+        if lookup is None:
+            continue
+        model, msg_class = lookup
+        try:
+            queue.put_nowait((model, msg_class(**entry)))
+        except asyncio.QueueFull:
+            logger.warning("Recording queue is full, dropped: %s", entry)
+
+
+async def write_live_data(
+    session, queue: asyncio.Queue, model_lookup: dict, batch_size: int
+):
+    """
+    Take entries from the queue and insert them to database in batches of
+    whatever has been queued, up to `batch_size` rows.
+    """
+    buffers = {model: [] for model, _ in model_lookup.values()}
+    try:
+        while True:
+            model, msg = await queue.get()
+            buffers[model].append(msg.as_row())
+            for _ in range(batch_size - 1):
+                try:
+                    model, msg = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                buffers[model].append(msg.as_row())
+            await flush_buffers(session, buffers)
+    finally:
+        # Write out the rows left in the queue as their own batch, also when
+        # the task is cancelled or a previous batch failed.
+        await session.rollback()
+        remaining = {model: [] for model in buffers}
+        while not queue.empty():
+            model, msg = queue.get_nowait()
+            remaining[model].append(msg.as_row())
+        try:
+            await flush_buffers(session, remaining)
+        except Exception:
+            logger.exception("Failed to write the remaining live data!")
+
+
 async def record_live_data(
-    exchange="deribit", symbols=["BTC-PERPETUAL"], data_types=["quote_1m"]
+    exchange="deribit",
+    symbols=["BTC-PERPETUAL"],
+    data_types=["quote_1m"],
+    batch_size=RECORD_BATCH_SIZE,
 ):
     # Get streaming generator
     stream = stream_live_data(exchange=exchange, symbols=symbols, data_types=data_types)
 
-    # Record live data to db
-    model_lookup = {"book_snapshot": models.BookSnapshot}
-    async_session = sessionmaker(
-        models.engine, expire_on_commit=False, class_=AsyncSession
-    )
-    async with async_session() as session:
-        async for entry in stream:
-            logger.info(f"Received Live Data: {entry}")
-            # Discard 1st live point which is not aligned with interval.
-            t = entry["timestamp"]
-            if (t.second * 1000 + t.microsecond / 1000) % entry["interval"] != 0:
-                continue
-            # Insert to database
-            model = model_lookup.get(entry["dtype"], None)
-            if model is not None:
-
-                row = model(**entry)
-                async with session.begin():
-                    session.add(row)
-                await session.commit()
+    # Record live data to db, with receiving decoupled from writing
+    model_lookup = {"book_snapshot": (models.BookSnapshot, models.BookSnapshotMsg)}
+    queue = asyncio.Queue(maxsize=RECORD_QUEUE_SIZE)
+    async with models.AsyncSessionLocal() as session:
+        tasks = [
+            asyncio.create_task(enqueue_live_data(stream, queue, model_lookup)),
+            asyncio.create_task(
+                write_live_data(session, queue, model_lookup, batch_size)
+            ),
+        ]
+        try:
+            # Stop both halves as soon as either one ends or fails.
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            task.result()  # raise the failure, if any
 
 
 async def get_data_without_gap_coro(
@@ -166,33 +420,82 @@ async def get_data_without_gap_coro(
     record_task = asyncio.create_task(record_co)
     logger.info("Live data recording started.")
 
+    # Download the bulk of historical data during warmup.
+    # Latest 15 min historical data unavailable
+    bulk_end = datetime.utcnow() - timedelta(minutes=15)
+    hist_start = bulk_end - lookback
+    # The replay API downloads from 00:00 of the `from` day, so split at the
+    # start of the latest available day: whole past days are downloaded
+    # during warmup, and the current day is downloaded after it.
+    tail_start = str(bulk_end.date())
+    if hist_start.date() < bulk_end.date():
+        bulk_co = get_hist_data(
+            exchange=exchange,
+            symbols=symbols,
+            data_types=data_types,
+            start=str(hist_start.date()),
+            end=tail_start,
+        )
+    else:
+        bulk_co = asyncio.sleep(0, result=[])
+    logger.info(f"Downloading historical data ...")
+    bulk_task = asyncio.create_task(
+        asyncio.wait_for(bulk_co, timeout=GET_HIST_DATA_TIMEOUT)
+    )
+
     logger.info(
         f"Warm up live data recording for {recording_warmup_seconds} seconds ..."
     )
     await asyncio.sleep(recording_warmup_seconds)
 
-    # Get historical data
-    # Latest 15 min historical data unavailable
+    # Get the current day of historical data, including what became
+    # available during warmup
     hist_end = datetime.utcnow() - timedelta(minutes=14)
-    hist_start = hist_end - lookback
-    hist_co = get_hist_data(
+    tail_co = get_hist_data(
         exchange=exchange,
         symbols=symbols,
         data_types=data_types,
-        start=str(hist_start.date()),
+        start=tail_start,
         end=str(hist_end),
     )
-    logger.info(f"Downloading historical data ...")
+    tail_task = asyncio.create_task(
+        asyncio.wait_for(tail_co, timeout=GET_HIST_DATA_TIMEOUT)
+    )
     try:
-        hist_data = await asyncio.wait_for(hist_co, timeout=GET_HIST_DATA_TIMEOUT)
+        try:
+            hist_data = await bulk_task
+        except asyncio.TimeoutError:
+            logger.error("Time out for getting historical data!")
+            hist_data = []
+        else:
+            try:
+                tail_data = await tail_task
+            except asyncio.TimeoutError:
+                logger.error(
+                    "Time out for getting the latest historical data! "
+                    "There may be a gap before the recorded live data."
+                )
+            else:
+                # Drop tail entries already in the bulk download
+                if hist_data:
+                    tail_data = tail_data[
+                        bisect_right(
+                            tail_data,
+                            hist_data[-1]["timestamp"],
+                            key=itemgetter("timestamp"),
+                        ) :
+                    ]
+                hist_data = hist_data + tail_data
+    finally:
+        bulk_task.cancel()
+        tail_task.cancel()
+    if hist_data:
         actual_hist_start = hist_data[0]["timestamp"]
         actual_hist_end = hist_data[-1]["timestamp"]
         logger.info(
             f"Downloaded historical data from {actual_hist_start} to {actual_hist_end}."
         )
-    except asyncio.TimeoutError:
-        logger.error("Time out for getting historical data!")
-        hist_data = []
+    else:
         actual_hist_start, actual_hist_end = None, None
 
     # Get recorded live data from database
@@ -201,17 +504,19 @@ async def get_data_without_gap_coro(
         query_start = actual_hist_end
     else:
         query_start = datetime.utcnow() - lookback
-    async_session = sessionmaker(
-        models.engine, expire_on_commit=False, class_=AsyncSession
-    )
-    async with async_session() as session:
+    async with models.AsyncSessionLocal() as session:
+        # Recorded data persist across runs, so only select this job's data.
         results = await session.execute(
-            select(models.BookSnapshot).where(
-                models.BookSnapshot.timestamp >= query_start
+            _SELECT_BOOKSNAPSHOTS.where(
+                _BOOKSNAPSHOT_COLS.exchange == exchange,
+                _BOOKSNAPSHOT_COLS.symbol.in_(symbols),
+                _BOOKSNAPSHOT_COLS.name.in_(data_types),
+                _BOOKSNAPSHOT_COLS.timestamp >= query_start,
             )
         )
+        rows = results.mappings().all()
         await session.commit()
-    recorded_data = parse_orm_select_results(results)
+    recorded_data = parse_select_results(rows)
     recorded_start = recorded_data[0]["timestamp"]
     recorded_end = recorded_data[-1]["timestamp"]
     logger.info(f"Get recorded live data from {recorded_start} to {recorded_end}.")
@@ -219,21 +524,24 @@ async def get_data_without_gap_coro(
     # Stop streaming and recording
     logger.info("Stop live data recording...")
     record_task.cancel()
-    while not record_task.cancelled():
-        await asyncio.sleep(0.1)
+    try:
+        await record_task
+    except asyncio.CancelledError:
+        pass
     logger.info("Live data recording stopped.")
 
-    # Combine historical data and recorded live data
-    combined_data = hist_data + recorded_data
-
     # Cut data to be exactly as the lookback requested,
     # as the API always downloads from 00:00 of a day.
-    i = 0
+    # Both lists are sorted by timestamp, so bisect each one.
     exact_start = recorded_end - lookback
-    for i, entry in enumerate(combined_data):
-        if entry["timestamp"] >= exact_start:
-            break
-    combined_data = combined_data[i:]
+    by_timestamp = itemgetter("timestamp")
+    hist_data = hist_data[bisect_left(hist_data, exact_start, key=by_timestamp) :]
+    recorded_data = recorded_data[
+        bisect_left(recorded_data, exact_start, key=by_timestamp) :
+    ]
+
+    # Combine historical data and recorded live data
+    combined_data = hist_data + recorded_data
     logger.info(
         f"The combined data are from {combined_data[0]['timestamp']} to {combined_data[-1]['timestamp']}."
     )
@@ -248,6 +556,9 @@ def get_data_without_gap(
     lookback: timedelta,
     recording_warmup_seconds: int,
 ):
+    # Run the event loops on libuv
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Initialize database
     asyncio.run(models.init_db())
 
@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 
 
-from sqlalchemy import Column
+from dataclasses import dataclass, fields
+from datetime import datetime
+from operator import attrgetter
+
+from sqlalchemy import Column, Index, UniqueConstraint
 from sqlalchemy import DateTime, Integer, Float, String
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
 
 
 Base = declarative_base()
 db_url = "sqlite+aiosqlite:///database.db"
 engine = create_async_engine(db_url, echo=False)
+AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Use WAL journal and relaxed fsync for cheaper commits."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 
 sample = {
     "type": "book_snapshot",
@@ -29,13 +47,20 @@ class BookSnapshot(Base):
     """The model class for a book/quote snapshot object."""
 
     __tablename__ = "booksnapshots"
-    dtype = Column(String, primary_key=True, nullable=False)
-    symbol = Column(String, primary_key=True, nullable=False)
-    exchange = Column(String, primary_key=True, nullable=False)
-    name = Column(String, primary_key=True, nullable=False)
+    __table_args__ = (
+        UniqueConstraint(
+            "dtype", "symbol", "exchange", "name", "timestamp", name="uq_booksnapshots"
+        ),
+        Index("ix_booksnapshots_ts", "timestamp"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dtype = Column(String, nullable=False)
+    symbol = Column(String, nullable=False)
+    exchange = Column(String, nullable=False)
+    name = Column(String, nullable=False)
     depth = Column(Integer)
     interval = Column(Integer, nullable=False)
-    timestamp = Column(DateTime, primary_key=True, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
     localTimestamp = Column(DateTime)
     bids_0_price = Column(Float)
     bids_0_amount = Column(Integer)
@@ -59,6 +84,48 @@ class BookSnapshot(Base):
     asks_4_amount = Column(Integer)
 
 
+@dataclass(slots=True)
+class BookSnapshotMsg:
+    """A flattened book/quote snapshot message, lighter than a dict."""
+
+    dtype: str
+    symbol: str
+    exchange: str
+    name: str
+    depth: int
+    interval: int
+    timestamp: datetime
+    localTimestamp: datetime
+    bids_0_price: float | None = None
+    bids_0_amount: int | None = None
+    bids_1_price: float | None = None
+    bids_1_amount: int | None = None
+    bids_2_price: float | None = None
+    bids_2_amount: int | None = None
+    bids_3_price: float | None = None
+    bids_3_amount: int | None = None
+    bids_4_price: float | None = None
+    bids_4_amount: int | None = None
+    asks_0_price: float | None = None
+    asks_0_amount: int | None = None
+    asks_1_price: float | None = None
+    asks_1_amount: int | None = None
+    asks_2_price: float | None = None
+    asks_2_amount: int | None = None
+    asks_3_price: float | None = None
+    asks_3_amount: int | None = None
+    asks_4_price: float | None = None
+    asks_4_amount: int | None = None
+
+    def as_row(self) -> dict:
+        """Return the fields as a row dictionary for inserting."""
+        return dict(zip(BOOK_SNAPSHOT_MSG_FIELDS, _get_book_snapshot_msg_fields(self)))
+
+
+BOOK_SNAPSHOT_MSG_FIELDS = tuple(f.name for f in fields(BookSnapshotMsg))
+_get_book_snapshot_msg_fields = attrgetter(*BOOK_SNAPSHOT_MSG_FIELDS)
+
+
 # helper functions used to initialize the database
 def create_schema(engine) -> None:
     Base.metadata.create_all(engine)
@@ -68,7 +135,9 @@ def drop_schema(engine) -> None:
     Base.metadata.drop_all(engine)
 
 
-async def init_db():
+async def init_db(reset: bool = False):
+    """Create missing tables, dropping all existing data first if `reset`."""
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
+        if reset:
+            await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)